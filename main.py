@@ -2,15 +2,21 @@
 """
 Super Efficient Video Streamer for Termux
 Captures back camera feed and streams via Flask with minimal overhead
+
+Served by waitress; pass --dev to use Flask's development server instead.
 """
 
+import argparse
+import json
 import subprocess
 import threading
 import time
 import io
-from flask import Flask, Response, render_template_string
-import queue
+import logging
+from flask import Flask, Response, request
+from waitress import serve
 import signal
+import socket
 import sys
 import os
 import platform
@@ -19,9 +25,39 @@ import shutil
 app = Flask(__name__)
 
 # Global variables
-frame_queue = queue.Queue(maxsize=2)  # Small buffer to reduce latency
+latest_frame = None  # Newest JPEG, shared by every viewer
+frame_seq = 0  # Bumped on each new frame so viewers can spot fresh ones
+active_clients = 0
+frames_dropped = 0  # Frames viewers skipped because they fell behind
+frame_ready = threading.Condition()  # Guards the frame and client state above
 camera_process = None
 streaming = False
+capture_command = None  # termux-camera-photo invocation that writes to stdout
+
+# Startup camera probes are slow; remember a working command for a day
+PROBE_CACHE = os.path.expanduser("~/.cache/termux-streamer.json")
+PROBE_CACHE_TTL = 24 * 60 * 60
+# Consecutive capture failures before the cached camera test is discarded
+MAX_CAPTURE_FAILURES = 5
+
+# Boundary and part headers written before each photo, CRLF after it
+FRAME_HEADER = b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+FRAME_TRAILER = b"\r\n"
+
+# APP1 segment holding only an EXIF Orientation tag (big-endian TIFF, one
+# IFD0 entry); %c is filled with the orientation value
+MINIMAL_EXIF = (
+    b"\xff\xe1\x00\x22Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08"
+    b"\x00\x01\x01\x12\x00\x03\x00\x00\x00\x01\x00%c\x00\x00\x00\x00\x00\x00"
+)
+
+# APPn segments safe to drop, keyed by marker and matched on their identifier:
+# EXIF and XMP in APP1, MPF (multi-picture thumbnails) in APP2. ICC profiles
+# share APP2 and Adobe colour info lives in APP14, both are kept.
+METADATA_SEGMENTS = {
+    0xE1: (b"Exif\x00\x00", b"http://ns.adobe.com/xap/1.0/\x00"),
+    0xE2: (b"MPF\x00",),
+}
 
 # HTML template for the viewer
 HTML_TEMPLATE = """
@@ -91,99 +127,203 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# The page has no template variables, so encode it once at import time
+INDEX_HTML = HTML_TEMPLATE.encode()
+
+
+def exif_orientation(tiff):
+    """Read the Orientation tag from IFD0 of an EXIF TIFF block"""
+    byte_order = {b"II": "little", b"MM": "big"}.get(tiff[:2])
+    if byte_order is None or len(tiff) < 8:
+        return None
+
+    ifd = int.from_bytes(tiff[4:8], byte_order)
+    if ifd + 2 > len(tiff):
+        return None
+    for i in range(int.from_bytes(tiff[ifd : ifd + 2], byte_order)):
+        entry = ifd + 2 + i * 12
+        if entry + 12 > len(tiff):
+            break
+        if int.from_bytes(tiff[entry : entry + 2], byte_order) == 0x0112:
+            return int.from_bytes(tiff[entry + 8 : entry + 10], byte_order)
+    return None
+
+
+def strip_jpeg_metadata(data, min_saving=4096):
+    """
+    Drop EXIF/XMP, MPF (multi-picture thumbnails) and comment segments
+    without decoding the image. ICC profiles and the Adobe APP14 block are
+    kept since they change how the image renders. The Orientation tag is
+    kept in a minimal EXIF block so browsers still rotate the photo correctly.
+    Returns the input unchanged if it can't be parsed or the saving is small.
+    """
+    if data[:2] != b"\xff\xd8":
+        return data
+
+    kept = [b"\xff\xd8"]
+    dropped = 0
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return data
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte before a marker
+            pos += 1
+            continue
+        if marker == 0xDA:  # Start of scan, the rest is image data
+            break
+
+        end = pos + 2 + int.from_bytes(data[pos + 2 : pos + 4], "big")
+        payload = data[pos + 4 : end]
+        if marker == 0xFE or payload.startswith(METADATA_SEGMENTS.get(marker, ())):
+            dropped += end - pos
+            if marker == 0xE1 and payload.startswith(b"Exif\x00\x00"):
+                orientation = exif_orientation(payload[6:])
+                if orientation in range(2, 9):  # Valid, non-identity rotations
+                    kept.append(MINIMAL_EXIF % orientation)
+        else:
+            kept.append(data[pos:end])
+        pos = end
+    else:
+        return data
+
+    if dropped < min_saving:
+        return data
+    kept.append(data[pos:])
+    return b"".join(kept)
+
 
 def capture_video():
     """
     Continuously capture video frames using termux-api
     Uses termux-camera-photo in a loop for efficiency
     """
-    global streaming, camera_process
+    global streaming, camera_process, latest_frame, frame_seq
 
     print("Starting video capture thread...")
+    failures = 0
+    cache_forgotten = False
 
     while streaming:
+        # A command that passed the camera test keeps failing, e.g. after the
+        # permission was revoked; forget it so the next start probes again
+        if failures >= MAX_CAPTURE_FAILURES and not cache_forgotten:
+            cache_forgotten = True
+            forget_probe_cache()
+            print("⚠️  Camera keeps failing, it will be re-tested on the next start")
+
+        # Don't fire the camera while nobody is watching
+        with frame_ready:
+            if not frame_ready.wait_for(lambda: active_clients, timeout=1.0):
+                continue
+
         try:
-            # Use termux-camera-photo with optimized settings
-            # -c 0 = back camera, -s = size (smaller for efficiency)
-            temp_file = "/data/data/com.termux/files/home/temp_photo.jpg"
-            cmd = [
-                "termux-camera-photo",
-                "-c",
-                "0",  # Back camera
-                temp_file,
-            ]
-
-            # Start camera process
+            # Use the stdout variant validated by check_termux_api so the
+            # JPEG arrives over the pipe instead of a temp file on flash
             process = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                capture_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
             )
 
             # Read the image data
             image_data, error = process.communicate(timeout=5)
 
             if process.returncode == 0 and image_data:
-                # Add frame to queue (non-blocking)
-                try:
-                    frame_queue.put_nowait(image_data)
-                except queue.Full:
-                    # Remove old frame if queue is full
-                    try:
-                        frame_queue.get_nowait()
-                        frame_queue.put_nowait(image_data)
-                    except queue.Empty:
-                        pass
+                failures = 0
+                cache_forgotten = False
+
+                # Metadata and thumbnails are useless to the viewer
+                image_data = strip_jpeg_metadata(image_data)
+
+                # Publish to every viewer at once
+                with frame_ready:
+                    latest_frame = image_data
+                    frame_seq += 1
+                    frame_ready.notify_all()
             else:
                 print(f"Camera error: {error.decode() if error else 'Unknown error'}")
+                failures += 1
                 time.sleep(0.1)
 
         except subprocess.TimeoutExpired:
             print("Camera timeout, retrying...")
             if process:
                 process.kill()
+            failures += 1
             time.sleep(0.1)
         except Exception as e:
             print(f"Capture error: {e}")
+            failures += 1
             time.sleep(0.1)
 
     print("Video capture thread stopped")
 
 
-def generate_frames():
+def generate_frames(client_disconnected=None):
     """
     Generator function to yield frames for streaming
+    client_disconnected is waitress's callback for noticing a dropped viewer
+    while no frames are being written
     """
-    print("Starting frame generator...")
+    global active_clients, frames_dropped
 
-    while streaming:
-        try:
-            # Get frame from queue with timeout
-            frame_data = frame_queue.get(timeout=1.0)
+    print("Starting frame generator...")
 
-            # Yield frame in multipart format
-            yield (
-                b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + frame_data + b"\r\n"
-            )
+    with frame_ready:
+        # Start from the current frame if capture is running; one left over
+        # from an idle period is stale, so wait for a new one instead
+        if active_clients and latest_frame is not None:
+            last_seen = frame_seq - 1
+        else:
+            last_seen = frame_seq
+        active_clients += 1
+        frame_ready.notify_all()
 
-        except queue.Empty:
-            # Send a placeholder if no frames available
-            continue
-        except Exception as e:
-            print(f"Frame generation error: {e}")
-            break
+    try:
+        while streaming:
+            # Wait until the capture thread publishes a frame we haven't sent
+            with frame_ready:
+                if not frame_ready.wait_for(
+                    lambda: frame_seq != last_seen, timeout=1.0
+                ):
+                    # A stalled camera means no write will fail, so ask the
+                    # server whether the viewer left to free this worker
+                    if client_disconnected and client_disconnected():
+                        break
+                    continue
+                # Only the newest frame is sent; anything in between is
+                # dropped rather than queued behind a slow client
+                frames_dropped += frame_seq - last_seen - 1
+                last_seen = frame_seq
+                frame_data = latest_frame
+
+            # Header, JPEG and trailer go out as one chunk, i.e. one send()
+            yield b"".join((FRAME_HEADER % len(frame_data), frame_data, FRAME_TRAILER))
+    finally:
+        with frame_ready:
+            active_clients -= 1
 
 
 @app.route("/")
 def index():
     """Serve the main viewer page"""
-    return render_template_string(HTML_TEMPLATE)
+    return Response(
+        INDEX_HTML,
+        mimetype="text/html",
+        headers={"Cache-Control": "public, max-age=3600"},
+    )
 
 
 @app.route("/video_feed")
 def video_feed():
     """Video streaming route"""
-    return Response(
-        generate_frames(), mimetype="multipart/x-mixed-replace; boundary=frame"
+    response = Response(
+        generate_frames(request.environ.get("waitress.client_disconnected")),
+        mimetype="multipart/x-mixed-replace; boundary=frame",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
     )
+    # Parts are already bytes, so skip Werkzeug's response iterable wrapper
+    response.direct_passthrough = True
+    return response
 
 
 @app.route("/status")
@@ -191,7 +331,9 @@ def status():
     """Status endpoint"""
     return {
         "streaming": streaming,
-        "queue_size": frame_queue.qsize(),
+        "clients": active_clients,
+        "frames_captured": frame_seq,
+        "frames_dropped": frames_dropped,
         "uptime": time.time(),
     }
 
@@ -204,8 +346,48 @@ def signal_handler(sig, frame):
     sys.exit(0)
 
 
-def check_termux_api():
+def load_probe_cache():
+    """Return the cached capture command if a recent probe succeeded"""
+    try:
+        with open(PROBE_CACHE) as f:
+            cache = json.load(f)
+        command = cache["command"]
+        # Only a termux-camera-photo argv is safe to hand to Popen
+        valid = (
+            isinstance(command, list)
+            and command
+            and all(isinstance(arg, str) for arg in command)
+            and command[0] == "termux-camera-photo"
+        )
+        if valid and time.time() - cache["ts"] < PROBE_CACHE_TTL:
+            return command
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def save_probe_cache(command):
+    """Remember the capture command that passed the camera test"""
+    try:
+        os.makedirs(os.path.dirname(PROBE_CACHE), exist_ok=True)
+        with open(PROBE_CACHE, "w") as f:
+            json.dump({"ts": time.time(), "command": command}, f)
+    except OSError as e:
+        print(f"⚠️  Could not save camera test result: {e}")
+
+
+def forget_probe_cache():
+    """Delete the cached camera test so the next start probes again"""
+    try:
+        os.remove(PROBE_CACHE)
+    except OSError:
+        pass
+
+
+def check_termux_api(use_cache=True):
     """Check if termux-api is available and test camera"""
+    global capture_command
+
     print("Checking Termux API setup...")
 
     # Check if we're on Android/Termux or another platform
@@ -233,6 +415,13 @@ def check_termux_api():
         print(f"✗ Error checking termux-camera-info: {e}")
         return False
 
+    # Skip the camera probes if they passed recently
+    cached_command = load_probe_cache() if use_cache else None
+    if cached_command:
+        print(f"✓ Using cached camera test: {' '.join(cached_command)}")
+        capture_command = cached_command
+        return True
+
     # Test 2: Check camera info
     try:
         result = subprocess.run(
@@ -263,6 +452,8 @@ def check_termux_api():
             result = subprocess.run(cmd, capture_output=True, timeout=8)
             if result.returncode == 0 and len(result.stdout) > 1000:
                 print(f"✓ Camera test {i + 1} successful! ({len(result.stdout)} bytes)")
+                capture_command = cmd
+                save_probe_cache(cmd)
                 return True
             else:
                 print(
@@ -282,15 +473,56 @@ def check_termux_api():
     return False
 
 
+def get_local_ip():
+    """
+    Find the LAN address other devices can reach us on. Connecting a UDP
+    socket only does a route lookup, no packet is sent and no DNS is used.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(("8.8.8.8", 80))
+        return sock.getsockname()[0]
+    except OSError:
+        return "0.0.0.0"
+    finally:
+        sock.close()
+
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Termux camera streamer")
+    parser.add_argument(
+        "--dev",
+        action="store_true",
+        help="use Flask's development server instead of waitress",
+    )
+    parser.add_argument(
+        "--recheck",
+        action="store_true",
+        help="ignore the cached camera test and probe termux-api again",
+    )
+    # The viewer page reloads itself when the stream errors, so each phone
+    # or browser tab can briefly hold two streams plus a /status request
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=32,
+        help="waitress worker threads, one per open stream (default: %(default)s)",
+    )
+    return parser.parse_args()
+
+
 def main():
     global streaming
 
+    args = parse_args()
+
     print("=" * 50)
     print("Termux Super Efficient Video Streamer")
     print("=" * 50)
 
     # Check termux-api availability
-    if not check_termux_api():
+    if not check_termux_api(use_cache=not args.recheck):
         print("\nPlease install termux-api:")
         print("pkg install termux-api")
         print("Also install the Termux:API app from F-Droid or Google Play")
@@ -311,21 +543,30 @@ def main():
     print(f"📱 Camera: Back camera (0)")
     print(f"🌐 Access your stream at:")
     print(f"   Local: http://127.0.0.1:5000")
-    print(f"   Network: http://0.0.0.0:5000")
-    print(f"   Status: http://0.0.0.0:5000/status")
+    local_ip = get_local_ip()
+    print(f"   Network: http://{local_ip}:5000")
+    print(f"   Status: http://{local_ip}:5000/status")
     print(f"\n⚡ Optimized for Termux with minimal overhead")
     print(f"📊 Resolution: 640x480 for efficiency")
+    if not args.dev:
+        print(f"👥 Up to {args.threads} requests at once, every viewer uses one")
     print(f"🔄 Press Ctrl+C to stop\n")
 
     try:
-        # Run Flask app
-        app.run(
-            host="0.0.0.0",
-            port=5000,
-            debug=False,  # Disable debug for better performance
-            threaded=True,
-            use_reloader=False,
-        )
+        if args.dev:
+            # Keep Werkzeug's per-request lines out of the console
+            logging.getLogger("werkzeug").setLevel(logging.WARNING)
+            app.run(host="0.0.0.0", port=5000, threaded=True, use_reloader=False)
+        else:
+            # Run Flask app under waitress instead of the Werkzeug dev server;
+            # request lookahead lets waitress report viewers that disconnect
+            serve(
+                app,
+                host="0.0.0.0",
+                port=5000,
+                threads=args.threads,
+                channel_request_lookahead=1,
+            )
     except KeyboardInterrupt:
         print("\nStopping server...")
     finally:
@@ -1,13 +1,38 @@
+import argparse
 import cv2
+import json
+import os
 import threading
 import time
-from flask import Flask, Response, render_template_string
+from flask import Flask, Response, request
+from waitress import serve
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# libjpeg-turbo bindings are much faster than cv2.imencode; fall back to
+# OpenCV when the shared library is not available on this machine
+try:
+    from turbojpeg import TurboJPEG, TJFLAG_FASTDCT, TJPF_BGR, TJSAMP_420
+    jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError) as e:
+    logger.warning(f"TurboJPEG unavailable, using cv2.imencode: {e}")
+    jpeg = None
+
+# cv2.imdecode flags that downscale by the given factor while decoding
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# Multipart envelope around each JPEG in the MJPEG stream
+FRAME_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+FRAME_TRAILER = b'\r\n'
+
 class PCCameraStreamer:
     def __init__(self, camera_index=0, fps=30, resolution=(640, 480), port=3000):
         self.camera_index = camera_index
@@ -16,13 +41,30 @@ class PCCameraStreamer:
         self.port = port
         self.cap = None
         self.frame = None
+        self.frame_bytes = None
+        self.scaled_frames = {}  # width -> (frame_count, JPEG bytes)
+        
+        # Capture buffers reused in turn so frames no longer cost a fresh
+        # allocation. With three, the buffer behind frame N is only refilled
+        # after N+2 is out, leaving a full frame interval for slow resizes
+        self.buffers = [None, None, None]
+        self.write_idx = 0
         self.is_streaming = False
+        self.passthrough = False
+        self.active_clients = 0
         self.lock = threading.Lock()
+        self.frame_ready = threading.Condition(self.lock)
+        self.update_health()
         
         # Performance tracking
         self.frame_count = 0
         self.start_time = time.time()
         self.actual_fps = 0
+        # FPS is measured from when viewers last arrived, not across idle spells
+        self.fps_start = time.time()
+        self.fps_base = 0
+        self.process_time = 0.0  # EWMA of per-frame encode + publish time
+        self.jpeg_quality = 80
         
     def initialize_camera(self):
         """Initialize the camera with optimal settings"""
@@ -48,62 +90,234 @@ class PCCameraStreamer:
             actual_height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
             actual_fps = self.cap.get(cv2.CAP_PROP_FPS)
             
-            logger.info(f"Camera initialized: {actual_width}x{actual_height} @ {actual_fps} FPS")
+            # Forward the driver's own JPEGs when it delivers the size we want
+            if (actual_width, actual_height) == tuple(self.resolution):
+                self.passthrough = self.enable_jpeg_passthrough()
+            
+            logger.info(f"Camera initialized: {actual_width}x{actual_height} @ {actual_fps} FPS"
+                        f"{' (MJPEG passthrough)' if self.passthrough else ''}")
             return True
             
         except Exception as e:
             logger.error(f"Error initializing camera: {e}")
             return False
     
+    def enable_jpeg_passthrough(self):
+        """Ask the backend for undecoded MJPEG buffers, keep it only if they are JPEGs"""
+        if int(self.cap.get(cv2.CAP_PROP_FOURCC)) != cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'):
+            return False
+        if not self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+            return False
+        
+        # Backends that ignore CONVERT_RGB still return decoded BGR frames
+        ret, frame = self.cap.read()
+        if ret and frame.size > 2 and frame.reshape(-1)[:2].tobytes() == b'\xff\xd8':
+            return True
+        
+        self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        return False
+    
+    def pin_to_fastest_core(self):
+        """Pin the calling thread to the highest-clocked core on big.LITTLE CPUs"""
+        if not hasattr(os, 'sched_setaffinity'):
+            return
+        
+        freqs = {}
+        for cpu in os.sched_getaffinity(0):
+            try:
+                with open(f'/sys/devices/system/cpu/cpu{cpu}/cpufreq/cpuinfo_max_freq') as f:
+                    freqs[cpu] = int(f.read())
+            except (OSError, ValueError):
+                # Without every core's clock (VMs, hotplug) big.LITTLE can't be told apart
+                return
+        
+        # Leave symmetric CPUs to the scheduler
+        if len(set(freqs.values())) < 2:
+            return
+        
+        fastest = max(freqs, key=freqs.get)
+        try:
+            os.sched_setaffinity(0, {fastest})
+            logger.info(f"Capture thread pinned to CPU {fastest}")
+        except OSError as e:
+            logger.warning(f"Could not pin capture thread: {e}")
+    
     def capture_frames(self):
         """Continuously capture frames from camera"""
         frame_time = 1.0 / self.fps
+        next_frame = time.monotonic()
+        self.pin_to_fastest_core()
         
+        idle = True
         while self.is_streaming:
-            start_capture = time.time()
+            # Nobody is watching: keep the camera ticking slowly, skip encoding
+            if not self.active_clients:
+                idle = True
+                self.cap.grab()
+                time.sleep(0.5)
+                continue
+            if idle:
+                idle = False
+                self.fps_start = time.time()
+                self.fps_base = self.frame_count
             
-            ret, frame = self.cap.read()
+            ret, frame = self.cap.read(self.buffers[self.write_idx])
             if ret:
-                # Resize frame if needed (for consistency)
-                if frame.shape[:2][::-1] != self.resolution:
-                    frame = cv2.resize(frame, self.resolution, interpolation=cv2.INTER_LINEAR)
+                start_process = time.time()
+                if self.passthrough:
+                    # The camera already compressed this frame, send it as is
+                    frame_bytes = frame.tobytes()
+                else:
+                    # Keep the array read() filled and move on to the next one
+                    self.buffers[self.write_idx] = frame
+                    self.write_idx = (self.write_idx + 1) % len(self.buffers)
+                    
+                    # Resize frame if needed (for consistency)
+                    if frame.shape[:2][::-1] != self.resolution:
+                        frame = cv2.resize(frame, self.resolution, interpolation=cv2.INTER_LINEAR)
+                    
+                    # Encode once here so every client shares the same JPEG
+                    frame_bytes = self.encode_frame(frame)
                 
-                # Update frame with thread safety
+                # Publish the frame; the next read() goes into another
+                # buffer so there is no need to copy it
                 with self.lock:
-                    self.frame = frame.copy()
+                    self.frame = frame
+                    self.frame_bytes = frame_bytes
                     self.frame_count += 1
+                    self.frame_ready.notify_all()
+                
+                # When processing can't keep up with the camera, skip the one
+                # frame CAP_PROP_BUFFERSIZE=1 lets queue so the next is fresh;
+                # any further grab() would just block on a new frame
+                process_time = time.time() - start_process
+                self.process_time = 0.9 * self.process_time + 0.1 * process_time
+                if self.process_time > frame_time:
+                    self.cap.grab()
                 
                 # Calculate actual FPS
                 if self.frame_count % 30 == 0:
-                    elapsed = time.time() - self.start_time
-                    self.actual_fps = self.frame_count / elapsed if elapsed > 0 else 0
+                    elapsed = time.time() - self.fps_start
+                    frames = self.frame_count - self.fps_base
+                    self.actual_fps = frames / elapsed if elapsed > 0 else 0
+                    
+                    # Give up some JPEG quality while encoding can't keep up,
+                    # win it back once there is headroom again
+                    if self.process_time > frame_time:
+                        self.jpeg_quality = max(40, self.jpeg_quality - 5)
+                    elif self.process_time < frame_time / 2:
+                        self.jpeg_quality = min(80, self.jpeg_quality + 5)
             
-            # Maintain target FPS
-            capture_time = time.time() - start_capture
-            sleep_time = max(0, frame_time - capture_time)
+            # Maintain target FPS against a monotonic deadline so the
+            # pacing neither drifts nor jumps with the wall clock
+            next_frame += frame_time
+            sleep_time = next_frame - time.monotonic()
             if sleep_time > 0:
                 time.sleep(sleep_time)
+            else:
+                next_frame = time.monotonic()  # Behind; don't try to catch up
     
-    def get_frame(self):
-        """Get the latest frame as JPEG bytes"""
-        with self.lock:
-            if self.frame is not None:
-                # Encode frame as JPEG with optimized quality
-                ret, buffer = cv2.imencode('.jpg', self.frame, 
-                                         [cv2.IMWRITE_JPEG_QUALITY, 80,
-                                          cv2.IMWRITE_JPEG_OPTIMIZE, 1])
-                if ret:
-                    return buffer.tobytes()
+    def encode_frame(self, frame):
+        """Encode a BGR frame as JPEG bytes"""
+        if jpeg is not None:
+            return jpeg.encode(frame, quality=self.jpeg_quality,
+                               pixel_format=TJPF_BGR,
+                               jpeg_subsample=TJSAMP_420,
+                               flags=TJFLAG_FASTDCT)
+        
+        # Encode frame as JPEG; skip the optimized-Huffman second pass,
+        # the few percent it saves are not worth it for a live stream
+        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if ret:
+            return buffer.tobytes()
         return None
     
-    def generate_frames(self):
-        """Generator function for Flask streaming"""
-        while self.is_streaming:
-            frame_bytes = self.get_frame()
-            if frame_bytes:
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-            time.sleep(0.01)  # Small delay to prevent excessive CPU usage
+    def decode_frame(self, data, width=None):
+        """
+        Decode a camera JPEG buffer to a BGR frame no narrower than width.
+        Returns None for a corrupt frame, which webcams emit now and then.
+        """
+        # Let libjpeg shrink by 1/2, 1/4 or 1/8 in the DCT while decoding so
+        # pixels that the resize would throw away are never reconstructed
+        scale = 1
+        while width and scale < 8 and self.resolution[0] // (scale * 2) >= width:
+            scale *= 2
+        
+        if jpeg is not None:
+            try:
+                return jpeg.decode(data, pixel_format=TJPF_BGR, flags=TJFLAG_FASTDCT,
+                                   scaling_factor=(1, scale) if scale > 1 else None)
+            except OSError as e:
+                logger.debug(f"Skipping undecodable camera frame: {e}")
+                return None
+        return cv2.imdecode(data, REDUCED_DECODE_FLAGS[scale])
+    
+    def get_frame(self, frame, frame_bytes, seq, width=None):
+        """JPEG bytes for published frame seq, optionally downscaled to width"""
+        if width is None or not 0 < width < self.resolution[0] or frame is None:
+            return frame_bytes
+        
+        # Snap to the 16px JPEG MCU grid, which also bounds the cache size
+        width = max(16, width - width % 16)
+        with self.lock:
+            cached = self.scaled_frames.get(width)
+            if cached is not None and cached[0] == seq:
+                return cached[1]
+        
+        # Encode outside the lock; clients sharing a width reuse the result
+        source = frame
+        if self.passthrough:
+            frame = self.decode_frame(frame, width)
+            if frame is None:
+                return None
+        height = max(16, width * frame.shape[0] // frame.shape[1])
+        if frame.shape[1] == width:
+            scaled = frame
+        else:
+            scaled = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        frame_bytes = self.encode_frame(scaled)
+        with self.lock:
+            # Once two newer frames are out, the capture thread may already
+            # be refilling this buffer, so the resize could be torn
+            if self.frame_count - seq >= 2 and any(source is b for b in self.buffers):
+                return None
+            self.scaled_frames[width] = (seq, frame_bytes)
+        return frame_bytes
+    
+    def generate_frames(self, width=None, client_disconnected=None):
+        """Generator function for Flask streaming, stops once client_disconnected() is true"""
+        with self.lock:
+            # Other viewers mean the capture loop is live and the current
+            # frame is fresh; the first viewer after idle waits for a new one
+            if self.active_clients and self.frame_bytes is not None:
+                last_seen = self.frame_count - 1
+            else:
+                last_seen = self.frame_count
+            self.active_clients += 1
+        
+        try:
+            while self.is_streaming:
+                # Block until the capture thread publishes a new frame so the
+                # same frame is never sent twice; take it together with its
+                # seq so a publish in between can't slip in early
+                with self.frame_ready:
+                    if not self.frame_ready.wait_for(
+                            lambda: self.frame_count != last_seen, timeout=1.0):
+                        # With the webcam stalled nothing gets written, so a
+                        # closed tab only shows up through waitress's check
+                        if client_disconnected and client_disconnected():
+                            break
+                        continue
+                    last_seen = self.frame_count
+                    frame, frame_bytes = self.frame, self.frame_bytes
+                
+                frame_bytes = self.get_frame(frame, frame_bytes, last_seen, width)
+                if frame_bytes:
+                    # Yield each part as one chunk so it goes out in a single write
+                    yield b''.join((FRAME_HEADER % len(frame_bytes), frame_bytes, FRAME_TRAILER))
+        finally:
+            with self.lock:
+                self.active_clients -= 1
     
     def start_streaming(self):
         """Start the camera streaming"""
@@ -112,6 +326,10 @@ class PCCameraStreamer:
         
         self.is_streaming = True
         self.start_time = time.time()
+        self.update_health()
+        
+        # Keep OpenCV on one core instead of a pool fighting the HTTP threads
+        cv2.setNumThreads(1)
         
         # Start capture thread
         capture_thread = threading.Thread(target=self.capture_frames, daemon=True)
@@ -123,10 +341,15 @@ class PCCameraStreamer:
     def stop_streaming(self):
         """Stop the camera streaming"""
         self.is_streaming = False
+        self.update_health()
         if self.cap:
             self.cap.release()
         logger.info("Camera streaming stopped")
     
+    def update_health(self):
+        """Serialize the health payload once per state change"""
+        self.health_json = json.dumps({'status': 'ok', 'streaming': self.is_streaming}).encode()
+    
     def get_stats(self):
         """Get streaming statistics"""
         return {
@@ -323,16 +546,25 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
+# Compile the page template once instead of on every request
+INDEX_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE)
+
 @app.route('/')
 def index():
     """Main page with video stream"""
-    return render_template_string(HTML_TEMPLATE)
+    return Response(INDEX_TEMPLATE.render(), mimetype='text/html',
+                    headers={'Cache-Control': 'public, max-age=3600'})
 
 @app.route('/video_feed')
 def video_feed():
-    """Video streaming route"""
-    return Response(streamer.generate_frames(),
-                   mimetype='multipart/x-mixed-replace; boundary=frame')
+    """Video streaming route, ?w=<pixels> requests a downscaled stream"""
+    width = request.args.get('w', type=int)
+    response = Response(streamer.generate_frames(width, request.environ.get('waitress.client_disconnected')),
+                        mimetype='multipart/x-mixed-replace; boundary=frame',
+                        headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+    # Hand the generator straight to the server, parts are already bytes
+    response.direct_passthrough = True
+    return response
 
 @app.route('/stats')
 def stats():
@@ -342,10 +574,19 @@ def stats():
 @app.route('/health')
 def health():
     """Health check endpoint"""
-    return {'status': 'ok', 'streaming': streamer.is_streaming}
+    return Response(streamer.health_json, mimetype='application/json')
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description='PC camera streamer')
+    # Besides its stream, each open page polls /stats every 2 s
+    parser.add_argument('--threads', type=int, default=32,
+                        help='size of the waitress worker pool, which bounds concurrent viewers (default: %(default)s)')
+    return parser.parse_args()
 
 def main():
     """Main function to start the camera streaming server"""
+    args = parse_args()
     try:
         logger.info("Starting PC Camera Streaming Server...")
         
@@ -354,10 +595,13 @@ def main():
             return
         
         logger.info("Server starting on http://localhost:3000")
+        logger.info(f"Using {args.threads} worker threads, each open stream holds one")
         logger.info("Press Ctrl+C to stop the server")
         
-        # Start Flask server
-        app.run(host='0.0.0.0', port=3000, debug=False, threaded=True)
+        # Serve with waitress instead of the Werkzeug dev server; reading
+        # ahead on each connection is what feeds waitress.client_disconnected
+        serve(app, host='0.0.0.0', port=3000, threads=args.threads,
+              channel_request_lookahead=1)
         
     except KeyboardInterrupt:
         logger.info("Shutting down server...")